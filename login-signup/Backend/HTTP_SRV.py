@@ -1,14 +1,36 @@
 
-from flask import Flask, request, jsonify, session
+from flask import Flask, request, jsonify, session, g, Response, has_request_context, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_session import Session
+from sqlalchemy import event, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from datetime import datetime, timedelta
+from itertools import groupby, islice
+from heapq import merge
+from collections import deque
 import os
+import sys
 from dotenv import load_dotenv
+import json
 import logging
+import threading
+import time
+import click
+import numpy as np
+
+from ratelimit import MemoryRateLimitStore, RedisRateLimitStore
+from timeseries import downsample_points, reduce_series, series_arrays
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
 
 load_dotenv()
 
@@ -27,6 +49,19 @@ app.config['SESSION_COOKIE_NAME'] = 'greenhouse_session'
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SECURE'] = False
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
+# 'raw' — каждая запись показаний в отдельной строке, 'rle' — повторы схлопываются в отрезки
+app.config['SENSOR_HISTORY_MODE'] = os.getenv('SENSOR_HISTORY_MODE', 'raw')
+app.config['SENSOR_HISTORY_TOLERANCE'] = float(os.getenv('SENSOR_HISTORY_TOLERANCE', '0'))
+app.config['SENSOR_HISTORY_MAX_GAP'] = timedelta(seconds=int(os.getenv('SENSOR_HISTORY_MAX_GAP', '600')))
+app.config['SENSOR_ARCHIVE_DIR'] = os.getenv(
+    'SENSOR_ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive')
+)
+app.config['RATE_LIMIT_ENABLED'] = os.getenv('RATE_LIMIT_ENABLED', '1') == '1'
+# Пусто — счётчики в памяти процесса, redis://... — общее хранилище для нескольких воркеров
+app.config['RATE_LIMIT_STORAGE_URL'] = os.getenv('RATE_LIMIT_STORAGE_URL', '')
+app.config['RATE_LIMIT_MAX_INFLIGHT'] = int(os.getenv('RATE_LIMIT_MAX_INFLIGHT', '64'))
+# Эндпоинты сэмплирующего профилировщика доступны только при PROFILER_ENABLED=1
+app.config['PROFILER_ENABLED'] = os.getenv('PROFILER_ENABLED', '0') == '1'
 
 db = SQLAlchemy(app)
 Session(app)
@@ -115,11 +150,791 @@ class SensorHistory(db.Model):
     value_type = db.Column(db.String(32), nullable=False) 
     value = db.Column(db.Float, nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_sensor_history_module_time', 'module_id', 'timestamp'),
+    )
+
+class SensorHistorySegment(db.Model):
+    __tablename__ = 'sensor_history_segments'
+    id = db.Column(db.Integer, primary_key=True)
+    module_id = db.Column(db.Integer, nullable=False)
+    value_type = db.Column(db.String(32), nullable=False)
+    value = db.Column(db.Float, nullable=False)
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=1)
+    __table_args__ = (
+        db.Index('ix_sensor_history_segments_lookup', 'module_id', 'value_type', 'end_time'),
+    )
+
+class SensorHistoryArchive(db.Model):
+    __tablename__ = 'sensor_history_archives'
+    id = db.Column(db.Integer, primary_key=True)
+    module_id = db.Column(db.Integer, nullable=False, index=True)
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    path = db.Column(db.String(255), nullable=False)
+    file_format = db.Column(db.String(16), nullable=False)
+
+HISTORY_VALUE_TYPES = ('temperature', 'humidity', 'light')
+HISTORY_TYPE_CODES = {value_type: code for code, value_type in enumerate(HISTORY_VALUE_TYPES)}
+ARCHIVE_CHUNK_ROWS = 10000
+STREAM_CHUNK_ROWS = 1000
+
+def record_reading(module_id, value_type, value, now):
+    metrics.inc('sensor_readings_ingested_total', (('value_type', value_type),))
+    if app.config['SENSOR_HISTORY_MODE'] != 'rle':
+        db.session.add(SensorHistory(module_id=module_id, value_type=value_type, value=value, timestamp=now))
+        return
+
+    segment = (
+        SensorHistorySegment.query
+        .filter_by(module_id=module_id, value_type=value_type)
+        .order_by(SensorHistorySegment.end_time.desc())
+        .first()
+    )
+    # Продлеваем отрезок, только если значение в пределах допуска и между показаниями нет разрыва
+    if (segment is not None
+            and abs(segment.value - value) <= app.config['SENSOR_HISTORY_TOLERANCE']
+            and now - segment.end_time <= app.config['SENSOR_HISTORY_MAX_GAP']):
+        segment.end_time = now
+        segment.count += 1
+        return
+
+    db.session.add(SensorHistorySegment(
+        module_id=module_id,
+        value_type=value_type,
+        value=value,
+        start_time=now,
+        end_time=now,
+        count=1
+    ))
+
+ARCHIVE_COLUMNS = ('timestamp', 'end_time', 'value_type', 'value', 'count')
+
+def _history_chunk_to_arrays(chunk):
+    # Строка архива — (start, end, value_type, value, count): показание или отрезок RLE целиком
+    starts = np.array([row[0] for row in chunk], dtype='datetime64[us]')
+    ends = np.array([row[1] for row in chunk], dtype='datetime64[us]')
+    codes = np.fromiter((HISTORY_TYPE_CODES[row[2]] for row in chunk), dtype=np.int8, count=len(chunk))
+    values = np.fromiter((row[3] for row in chunk), dtype=np.float64, count=len(chunk))
+    counts = np.fromiter((row[4] for row in chunk), dtype=np.int32, count=len(chunk))
+    return starts, ends, codes, values, counts
+
+def _archive_filters(module_id, start, end):
+    rows_filter = (
+        SensorHistory.module_id == module_id,
+        SensorHistory.timestamp >= start,
+        SensorHistory.timestamp < end,
+        SensorHistory.value_type.in_(HISTORY_VALUE_TYPES)
+    )
+    # Отрезок архивируется целиком, когда закончился до конца диапазона; пересекающий границу остаётся живым
+    segments_filter = (
+        SensorHistorySegment.module_id == module_id,
+        SensorHistorySegment.end_time >= start,
+        SensorHistorySegment.end_time < end,
+        SensorHistorySegment.value_type.in_(HISTORY_VALUE_TYPES)
+    )
+    return rows_filter, segments_filter
+
+def _iter_archive_rows(module_id, value_type, rows_filter, segments_filter):
+    # yield_per включает серверный курсор — строки приходят пачками и не копятся в памяти
+    rows = (
+        db.session.query(SensorHistory.timestamp, SensorHistory.value_type, SensorHistory.value)
+        .filter(*rows_filter, SensorHistory.value_type == value_type)
+        .order_by(SensorHistory.timestamp)
+        .yield_per(ARCHIVE_CHUNK_ROWS)
+    )
+    stored_segments = (
+        db.session.query(SensorHistorySegment)
+        .filter(*segments_filter, SensorHistorySegment.value_type == value_type)
+        .order_by(SensorHistorySegment.start_time)
+        .yield_per(ARCHIVE_CHUNK_ROWS)
+    )
+
+    # Отрезок хранится целиком, с концом и числом показаний, чтобы при чтении весить как живой
+    return merge(
+        ((row[0], row[0], row[1], row[2], 1) for row in rows),
+        ((seg.start_time, seg.end_time, value_type, seg.value, seg.count) for seg in stored_segments),
+        key=lambda row: row[0]
+    )
+
+def export_history(module_id, start, end, delete=False):
+    rows_filter, segments_filter = _archive_filters(module_id, start, end)
+    # Архив упорядочен по (value_type, timestamp): внутри каждого типа точки идут по времени
+    rows = (
+        row
+        for value_type in HISTORY_VALUE_TYPES
+        for row in _iter_archive_rows(module_id, value_type, rows_filter, segments_filter)
+    )
+
+    archive_dir = app.config['SENSOR_ARCHIVE_DIR']
+    os.makedirs(archive_dir, exist_ok=True)
+    base_path = os.path.join(archive_dir, f"module_{module_id}_{start:%Y%m%dT%H%M%S}_{end:%Y%m%dT%H%M%S}")
+    row_count = 0
+
+    if pq is not None:
+        path = base_path + '.parquet'
+        file_format = 'parquet'
+        schema = pa.schema([
+            ('timestamp', pa.timestamp('us')),
+            ('end_time', pa.timestamp('us')),
+            ('value_type', pa.int8()),
+            ('value', pa.float64()),
+            ('count', pa.int32())
+        ])
+        with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+            while True:
+                chunk = list(islice(rows, ARCHIVE_CHUNK_ROWS))
+                if not chunk:
+                    break
+                arrays = [pa.array(column) for column in _history_chunk_to_arrays(chunk)]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                row_count += len(chunk)
+        if row_count == 0:
+            os.remove(path)
+    else:
+        # Без pyarrow архив — каталог сжатых npz, по файлу на пачку, чтобы не собирать всё в памяти
+        path = base_path
+        file_format = 'npz'
+        os.makedirs(path, exist_ok=True)
+        part = 0
+        while True:
+            chunk = list(islice(rows, ARCHIVE_CHUNK_ROWS))
+            if not chunk:
+                break
+            np.savez_compressed(
+                os.path.join(path, f"part_{part:06d}.npz"),
+                **dict(zip(ARCHIVE_COLUMNS, _history_chunk_to_arrays(chunk)))
+            )
+            part += 1
+            row_count += len(chunk)
+        if row_count == 0:
+            os.rmdir(path)
+
+    if row_count == 0:
+        return None
+
+    archive = SensorHistoryArchive(
+        module_id=module_id,
+        start_time=start,
+        end_time=end,
+        row_count=row_count,
+        path=path,
+        file_format=file_format
+    )
+    db.session.add(archive)
+    if delete:
+        SensorHistory.query.filter(*rows_filter).delete(synchronize_session=False)
+        SensorHistorySegment.query.filter(*segments_filter).delete(synchronize_session=False)
+    db.session.commit()
+    return archive
+
+def _archive_batch(columns):
+    # Ранние архивы хранили только точки — читаем их как отрезки из одного показания
+    starts = columns['timestamp']
+    ends = columns['end_time'] if 'end_time' in columns else starts
+    counts = columns['count'] if 'count' in columns else np.ones(starts.size, dtype=np.int32)
+    return starts, ends, columns['value_type'], columns['value'], counts
+
+def iter_archive(archive, code=None):
+    # Отдаёт пачки (starts, ends, codes, values, counts); code — читать только пачки, где встречается этот тип
+    if archive.file_format == 'parquet':
+        if pq is None:
+            raise RuntimeError(f"Для чтения архива {archive.path} требуется pyarrow")
+        parquet = pq.ParquetFile(archive.path, memory_map=True)
+        names = parquet.schema_arrow.names
+        type_index = names.index('value_type')
+        row_groups = []
+        for i in range(parquet.num_row_groups):
+            stats = parquet.metadata.row_group(i).column(type_index).statistics
+            if code is None or stats is None or not stats.has_min_max or stats.min <= code <= stats.max:
+                row_groups.append(i)
+        if not row_groups:
+            return
+        for batch in parquet.iter_batches(batch_size=ARCHIVE_CHUNK_ROWS, row_groups=row_groups):
+            yield _archive_batch({
+                name: batch.column(i).to_numpy(zero_copy_only=False) for i, name in enumerate(names)
+            })
+        return
+    for name in sorted(os.listdir(archive.path)):
+        with np.load(os.path.join(archive.path, name)) as data:
+            # Члены npz распаковываются по обращению: сначала смотрим только на короткий столбец типов
+            if code is not None and not (data['value_type'] == code).any():
+                continue
+            yield _archive_batch({column: data[column] for column in data.files})
+
+def archive_points(batch, since, segments=False, code=None):
+    # Разворачивает пачку архива так же, как живые строки и отрезки: (value_type, точка)
+    starts, ends, codes, values, counts = batch
+    mask = ends >= np.datetime64(since, 'us')
+    if code is not None:
+        mask &= codes == code
+    for start, end, c, value, count in zip(*(column[mask].tolist() for column in batch)):
+        value_type = HISTORY_VALUE_TYPES[c]
+        if segments:
+            yield value_type, (start, end, value, count)
+            continue
+        start = max(start, since)
+        yield value_type, (start, value)
+        if end != start:
+            yield value_type, (end, value)
+
+def _group_by_module(rows, module_ids):
+    # rows упорядочены по module_id; для каждого модуля из module_ids отдаём его строки (или пустой кортеж).
+    # Группу нужно дочитать до перехода к следующему модулю — groupby делит с ней один курсор
+    groups = groupby(rows, key=lambda row: row.module_id)
+    current = next(groups, None)
+    for module_id in module_ids:
+        while current is not None and current[0] < module_id:
+            current = next(groups, None)
+        if current is not None and current[0] == module_id:
+            yield current[1]
+            current = next(groups, None)
+        else:
+            yield ()
+
+def iter_history_by_module(module_ids, since, segments=False):
+    module_ids = sorted(set(module_ids))
+    if not module_ids:
+        return
+
+    archives = {}
+    for archive in (
+        SensorHistoryArchive.query
+        .filter(SensorHistoryArchive.module_id.in_(module_ids), SensorHistoryArchive.end_time > since)
+        .order_by(SensorHistoryArchive.start_time)
+    ):
+        archives.setdefault(archive.module_id, []).append(archive)
+
+    # Один запрос на таблицу для всех модулей, серверные курсоры упорядочены по module_id —
+    # в памяти держим историю только текущего модуля
+    rows = (
+        db.session.query(SensorHistory.module_id, SensorHistory.value_type, SensorHistory.timestamp, SensorHistory.value)
+        .filter(SensorHistory.module_id.in_(module_ids), SensorHistory.timestamp >= since)
+        .order_by(SensorHistory.module_id, SensorHistory.timestamp)
+        .yield_per(STREAM_CHUNK_ROWS)
+    )
+    stored_segments = (
+        db.session.query(SensorHistorySegment)
+        .filter(SensorHistorySegment.module_id.in_(module_ids), SensorHistorySegment.end_time >= since)
+        .order_by(SensorHistorySegment.module_id, SensorHistorySegment.start_time)
+        .yield_per(STREAM_CHUNK_ROWS)
+    )
+
+    for module_id, module_rows, module_segments in zip(
+        module_ids, _group_by_module(rows, module_ids), _group_by_module(stored_segments, module_ids)
+    ):
+        history = {value_type: [] for value_type in HISTORY_VALUE_TYPES}
+
+        # Архивы покрывают историю непрерывно от начала, живые данные читаем только после последнего архива
+        live_since = since
+        for archive in archives.get(module_id, ()):
+            live_since = max(live_since, archive.end_time)
+            for batch in iter_archive(archive):
+                for value_type, point in archive_points(batch, since, segments):
+                    history[value_type].append(point)
+
+        for entry in module_rows:
+            if entry.value_type not in history or entry.timestamp < live_since:
+                continue
+            if segments:
+                history[entry.value_type].append((entry.timestamp, entry.timestamp, float(entry.value), 1))
+            else:
+                history[entry.value_type].append((entry.timestamp, float(entry.value)))
+
+        for seg in module_segments:
+            if seg.value_type not in history or seg.end_time < live_since:
+                continue
+            if segments:
+                history[seg.value_type].append((seg.start_time, seg.end_time, seg.value, seg.count))
+                continue
+            # Отрезок разворачивается в точки начала и конца — ступенчатый график остаётся точным.
+            # Отрезок, начавшийся до since, начинается с границы окна, чтобы значение было видно с её начала
+            start_time = max(seg.start_time, since)
+            history[seg.value_type].append((start_time, seg.value))
+            if seg.end_time != start_time:
+                history[seg.value_type].append((seg.end_time, seg.value))
+
+        for points in history.values():
+            points.sort(key=lambda p: p[0])
+        yield module_id, history
+
+def collect_history_many(module_ids, since, segments=False):
+    return dict(iter_history_by_module(module_ids, since, segments=segments))
+
+def collect_history(module_id, since, segments=False):
+    return collect_history_many([module_id], since, segments=segments)[module_id]
+
+def iter_history(module_id, value_type, since, segments=False):
+    # Отдаёт (time, value) или, при segments=True, (start, end, value, count) в порядке времени
+    live_since = since
+    archives = (
+        SensorHistoryArchive.query
+        .filter(SensorHistoryArchive.module_id == module_id, SensorHistoryArchive.end_time > since)
+        .order_by(SensorHistoryArchive.start_time)
+        .all()
+    )
+    code = HISTORY_TYPE_CODES[value_type]
+    for archive in archives:
+        live_since = max(live_since, archive.end_time)
+        for batch in iter_archive(archive, code):
+            yield from (point for _, point in archive_points(batch, since, segments, code))
+
+    rows = (
+        db.session.query(SensorHistory.timestamp, SensorHistory.value)
+        .filter(
+            SensorHistory.module_id == module_id,
+            SensorHistory.value_type == value_type,
+            SensorHistory.timestamp >= live_since
+        )
+        .order_by(SensorHistory.timestamp)
+        .yield_per(STREAM_CHUNK_ROWS)
+    )
+    stored_segments = (
+        db.session.query(SensorHistorySegment)
+        .filter(
+            SensorHistorySegment.module_id == module_id,
+            SensorHistorySegment.value_type == value_type,
+            SensorHistorySegment.end_time >= live_since
+        )
+        .order_by(SensorHistorySegment.start_time)
+        .yield_per(STREAM_CHUNK_ROWS)
+    )
+
+    def segment_points():
+        for seg in stored_segments:
+            if segments:
+                yield seg.start_time, seg.end_time, seg.value, seg.count
+                continue
+            start_time = max(seg.start_time, since)
+            yield start_time, seg.value
+            if seg.end_time != start_time:
+                yield seg.end_time, seg.value
+
+    if segments:
+        row_points = ((row.timestamp, row.timestamp, float(row.value), 1) for row in rows)
+    else:
+        row_points = ((row.timestamp, float(row.value)) for row in rows)
+    # Строки и отрезки уже отсортированы по времени — сливаем потоки, не накапливая их в памяти
+    yield from merge(row_points, segment_points(), key=lambda point: point[0])
+
+def wants_ndjson():
+    if request.args.get('format') == 'ndjson':
+        return True
+    return request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+def stream_response(body, mimetype):
+    # Тело потокового ответа формируется уже после teardown_request, поэтому слот в очереди,
+    # ошибки и метрики привязаны ко времени жизни самого потока
+    g.streaming = True
+    request_g = g._get_current_object()
+    endpoint = request.endpoint
+
+    def guarded():
+        try:
+            yield from body
+        except Exception:
+            request_g.stream_failed = True
+            app.logger.exception(f"Streaming error in {endpoint}")
+            raise
+        finally:
+            release_inflight(request_g)
+
+    response = Response(stream_with_context(guarded()), mimetype=mimetype)
+    # Если клиент отключился до начала тела, генератор не запускается — слот освобождаем при закрытии
+    response.call_on_close(lambda: release_inflight(request_g))
+    return response
+
+def stream_json_array(items, prefix='', suffix=''):
+    # Элементы склеиваются пачками, чтобы не отправлять по чанку на каждый элемент
+    yield prefix + '['
+    separator = ''
+    buffer = []
+    for item in items:
+        buffer.append(json.dumps(item, ensure_ascii=False))
+        if len(buffer) >= STREAM_CHUNK_ROWS:
+            yield separator + ','.join(buffer)
+            separator = ','
+            buffer = []
+    if buffer:
+        yield separator + ','.join(buffer)
+    yield ']' + suffix
+
+def stream_ndjson(items):
+    buffer = []
+    for item in items:
+        buffer.append(json.dumps(item, ensure_ascii=False))
+        if len(buffer) >= STREAM_CHUNK_ROWS:
+            yield '\n'.join(buffer) + '\n'
+            buffer = []
+    if buffer:
+        yield '\n'.join(buffer) + '\n'
 
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+# Metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LATENCY_QUANTILES = (0.5, 0.95, 0.99)
+LATENCY_SAMPLES = 1024
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._samples = {}
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            key = (name, labels)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            key = (name, labels)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+                self._samples[key] = deque(maxlen=LATENCY_SAMPLES)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+            self._samples[key].append(value)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = tuple(labels) + tuple(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def render(self, gauges=()):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, ([*h[0]], h[1], h[2])) for key, h in self._histograms.items())
+            samples = {key: np.array(values) for key, values in self._samples.items()}
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for name, labels, value in gauges:
+            if name not in typed:
+                lines.append(f"# TYPE {name} gauge")
+                typed.add(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f"{name}_bucket{self._labels(labels, (('le', bound),))} {bucket_count}")
+            lines.append(f"{name}_bucket{self._labels(labels, (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        # Квантили по последним LATENCY_SAMPLES замерам — сразу видно p50/p95/p99 без Prometheus
+        for (name, labels), values in sorted(samples.items()):
+            summary = f"{name}_recent"
+            if summary not in typed:
+                lines.append(f"# TYPE {summary} summary")
+                typed.add(summary)
+            for q, value in zip(LATENCY_QUANTILES, np.quantile(values, LATENCY_QUANTILES)):
+                lines.append(f"{summary}{self._labels(labels, (('quantile', q),))} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+class SamplingProfiler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.interval = 0.01
+        self.samples = 0
+        self.stacks = {}
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval):
+        with self._lock:
+            if self.running:
+                return False
+            self.interval = interval
+            self.samples = 0
+            self.stacks = {}
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                with self._lock:
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def collapsed(self):
+        # Формат collapsed stacks — подходит для flamegraph.pl и speedscope
+        with self._lock:
+            stacks = sorted(self.stacks.items(), key=lambda item: -item[1])
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks)
+
+profiler = SamplingProfiler()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    # Время старта храним в контексте выполнения: он живёт один запрос и не копится при ошибках
+    context._query_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_started
+    if has_request_context():
+        g.db_time = g.get('db_time', 0.0) + elapsed
+        g.db_queries = g.get('db_queries', 0) + 1
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.db_time = 0.0
+    g.db_queries = 0
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    # Потоковое тело формируется уже после after_request, поэтому замеры снимаем при закрытии ответа.
+    # К этому моменту контекст запроса может быть снят — нужные значения захватываем заранее
+    request_g = g._get_current_object()
+    labels = (('endpoint', request.endpoint or 'unknown'),)
+    method = request.method
+
+    def record():
+        # Оборванный ошибкой поток уже отправил 200 в заголовках, но считается как 500
+        status = 500 if request_g.get('stream_failed') else response.status_code
+        metrics.observe('http_request_duration_seconds', labels, time.perf_counter() - started)
+        metrics.observe('http_request_db_seconds', labels, request_g.get('db_time', 0.0))
+        metrics.inc('db_queries_total', labels, request_g.get('db_queries', 0))
+        metrics.inc('http_requests_total', labels + (('method', method), ('status', status)))
+
+    response.call_on_close(record)
+    return response
+
+@app.teardown_request
+def record_request_failure(exc):
+    # after_request не вызывается при необработанном исключении. Ошибки потоковых ответов
+    # учитывает сам поток (stream_response) — к этому моменту after_request уже отработал
+    if exc is not None and not g.get('streaming'):
+        metrics.inc('http_requests_total', (('endpoint', request.endpoint or 'unknown'), ('method', request.method), ('status', 500)))
+        app.logger.exception(f"Unhandled error in {request.endpoint}", exc_info=exc)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    with _inflight_lock:
+        gauges = [('http_requests_inflight', (), _inflight_requests)]
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/profiler/start', methods=['POST'])
+@login_required
+def start_profiler():
+    if not app.config['PROFILER_ENABLED']:
+        return jsonify({'error': 'Profiler disabled'}), 404
+    data = request.get_json(silent=True) or {}
+    try:
+        interval = float(data.get('interval', 0.01))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid interval'}), 400
+    if not profiler.start(max(interval, 0.001)):
+        return jsonify({'error': 'Profiler already running'}), 400
+    return jsonify({'message': 'Profiler started', 'interval': profiler.interval}), 200
+
+@app.route('/api/profiler/stop', methods=['POST'])
+@login_required
+def stop_profiler():
+    if not app.config['PROFILER_ENABLED']:
+        return jsonify({'error': 'Profiler disabled'}), 404
+    profiler.stop()
+    return jsonify({'message': 'Profiler stopped', 'samples': profiler.samples}), 200
+
+@app.route('/api/profiler', methods=['GET'])
+@login_required
+def get_profile():
+    if not app.config['PROFILER_ENABLED']:
+        return jsonify({'error': 'Profiler disabled'}), 404
+    return Response(profiler.collapsed(), mimetype='text/plain')
+
+# Rate limiting
+# endpoint -> (токенов в секунду, размер корзины, по чему считаем: mac / module / user / ip / login или кортеж из них)
+RATE_LIMITS = {
+    'adjust_parameters': (2.0, 10, 'mac'),
+    'get_module_status': (1.0, 5, 'mac'),
+    'connect_module': (0.5, 5, 'ip'),
+    'update_sensor_values': (1.0, 5, 'module'),
+    'login': (0.2, 5, ('ip', 'login')),
+    'register': (0.05, 3, 'ip'),
+    'get_module_history_24h': (1.0, 10, 'user'),
+    'get_greenhouse_history': (0.5, 5, 'user'),
+    'get_greenhouse_analytics': (0.5, 5, 'user'),
+    'connect_modules_bulk': (0.1, 2, 'user'),
+    'claim_modules_bulk': (0.1, 2, 'user'),
+}
+RATE_LIMIT_DEFAULT = (5.0, 20, 'user')
+# Общая корзина на IP для пользовательских запросов
+RATE_LIMIT_PER_IP = (20.0, 100)
+# Устройства площадки часто выходят через один NAT-адрес, поэтому для них потолок на IP намного выше.
+# Он нужен, потому что MAC и module_id присылает сам клиент и перебором ключей их корзины обходятся
+RATE_LIMIT_DEVICE_PER_IP = (200.0, 1000)
+
+# 0 — управление, никогда не отбрасывается; чем больше число, тем раньше запрос отбрасывается под нагрузкой
+REQUEST_PRIORITY = {
+    'adjust_parameters': 0,
+    'get_module_status': 1,
+    'connect_module': 1,
+    'update_sensor_values': 1,
+    'get_metrics': 1,
+    'get_module_history_24h': 3,
+    'get_greenhouse_history': 3,
+    'get_greenhouse_analytics': 3,
+    'connect_modules_bulk': 3,
+    'claim_modules_bulk': 3,
+}
+REQUEST_PRIORITY_DEFAULT = 2
+# Доля от RATE_LIMIT_MAX_INFLIGHT, после которой запросы данного приоритета отбрасываются
+LOAD_SHED_THRESHOLDS = {1: 1.0, 2: 0.8, 3: 0.5}
+
+if app.config['RATE_LIMIT_STORAGE_URL']:
+    rate_limit_store = RedisRateLimitStore(app.config['RATE_LIMIT_STORAGE_URL'])
+else:
+    rate_limit_store = MemoryRateLimitStore()
+
+rate_limit_rejections = {}
+_inflight_lock = threading.Lock()
+_inflight_requests = 0
+
+def _count_rejection(endpoint, reason):
+    with _inflight_lock:
+        rate_limit_rejections[(endpoint, reason)] = rate_limit_rejections.get((endpoint, reason), 0) + 1
+    metrics.inc('rate_limit_rejections_total', (('endpoint', endpoint), ('reason', reason)))
+
+def _rate_limit_key(kind):
+    value = None
+    if kind == 'login':
+        # Подбор пароля к одной учётной записи с разных адресов; без логина хватает корзины по IP
+        login = (request.get_json(silent=True) or {}).get('login')
+        if not isinstance(login, str) or not login:
+            return None
+        return f"login:{login[:50]}"
+    if kind == 'mac':
+        value = request.headers.get('X-Module-MAC')
+    elif kind == 'module':
+        value = (request.view_args or {}).get('module_id') or request.headers.get('X-Module-ID')
+    elif kind == 'user' and current_user.is_authenticated:
+        value = current_user.get_id()
+    if value is None:
+        kind, value = 'ip', request.remote_addr
+    return f"{kind}:{value}"
+
+def _consume(key, rate, burst):
+    try:
+        return rate_limit_store.consume(key, rate, burst, time.time())
+    except Exception as e:
+        # Недоступное общее хранилище не должно класть весь сервер — пропускаем запрос
+        app.logger.warning(f"Rate limit store error: {e}")
+        return True, 0.0
+
+def _rejected(endpoint, reason, retry_after, status):
+    _count_rejection(endpoint, reason)
+    response = jsonify({'error': 'Слишком много запросов, повторите позже'})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+    return response
+
+@app.before_request
+def admit_request():
+    global _inflight_requests
+    if not app.config['RATE_LIMIT_ENABLED'] or request.method == 'OPTIONS' or request.endpoint is None:
+        return None
+    endpoint = request.endpoint
+
+    priority = REQUEST_PRIORITY.get(endpoint, REQUEST_PRIORITY_DEFAULT)
+    threshold = LOAD_SHED_THRESHOLDS.get(priority)
+    with _inflight_lock:
+        if threshold is not None and _inflight_requests >= app.config['RATE_LIMIT_MAX_INFLIGHT'] * threshold:
+            shed = True
+        else:
+            shed = False
+            _inflight_requests += 1
+            g.admitted = True
+    if shed:
+        return _rejected(endpoint, 'load_shed', 1, 503)
+
+    # Управляющий трафик устройств (приоритеты 0 и 1) получает отдельный, более щедрый потолок на IP
+    if priority > 1:
+        allowed, retry_after = _consume(f"ip:{request.remote_addr}", *RATE_LIMIT_PER_IP)
+    else:
+        allowed, retry_after = _consume(f"device-ip:{request.remote_addr}", *RATE_LIMIT_DEVICE_PER_IP)
+    if not allowed:
+        return _rejected(endpoint, 'ip', retry_after, 429)
+
+    rate, burst, kinds = RATE_LIMITS.get(endpoint, RATE_LIMIT_DEFAULT)
+    for kind in (kinds,) if isinstance(kinds, str) else kinds:
+        key = _rate_limit_key(kind)
+        if key is None:
+            continue
+        allowed, retry_after = _consume(f"{endpoint}:{key}", rate, burst)
+        if not allowed:
+            return _rejected(endpoint, kind, retry_after, 429)
+    return None
+
+def release_inflight(request_g):
+    global _inflight_requests
+    if request_g.pop('admitted', False):
+        with _inflight_lock:
+            _inflight_requests -= 1
+
+@app.teardown_request
+def release_request(exc):
+    # Потоковый ответ держит слот, пока отдаётся тело: его освобождает stream_response
+    if not g.get('streaming'):
+        release_inflight(g._get_current_object())
+
+@app.route('/api/rate-limit/stats', methods=['GET'])
+def get_rate_limit_stats():
+    with _inflight_lock:
+        rejections = [
+            {'endpoint': endpoint, 'reason': reason, 'count': count}
+            for (endpoint, reason), count in sorted(rate_limit_rejections.items())
+        ]
+        inflight = _inflight_requests
+    return jsonify({'inflight': inflight, 'rejections': rejections}), 200
+
 @app.route('/api/auth/login', methods=['POST'])
 def login():
     data = request.get_json()
@@ -296,17 +1111,72 @@ def connect_module():
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/modules/available', methods=['GET'])
+BULK_PROVISION_LIMIT = 1000
+
+@app.route('/api/modules/connect/bulk', methods=['POST'])
 @login_required
-def get_available_modules():
+def connect_modules_bulk():
     try:
-        modules = SmartGreenhouseModule.query.filter(
-            SmartGreenhouseModule.id.is_(None)
-        ).all()
-        result = [m.to_dict() for m in modules]
-        return jsonify(result), 200
+        data = request.get_json() or {}
+        items = data.get('modules') or []
+        if not isinstance(items, list) or not items:
+            return jsonify({"error": "Требуется список модулей"}), 400
+        if len(items) > BULK_PROVISION_LIMIT:
+            return jsonify({"error": f"Не более {BULK_PROVISION_LIMIT} модулей за запрос"}), 400
+
+        # ON CONFLICT не может обновить одну строку дважды, поэтому повторы MAC схлопываем
+        rows = {}
+        for item in items:
+            mac = item.get('mac_address') if isinstance(item, dict) else None
+            ip = item.get('ip_address') if isinstance(item, dict) else None
+            if not mac or not ip:
+                return jsonify({"error": "Требуются MAC и IP адреса"}), 400
+            rows[mac] = {'mac_address': mac, 'ip_address': ip, 'is_active': False}
+
+        stmt = pg_insert(SmartGreenhouseModule).values(list(rows.values()))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[SmartGreenhouseModule.mac_address],
+            set_={'ip_address': stmt.excluded.ip_address}
+        ).returning(
+            SmartGreenhouseModule.module_id,
+            SmartGreenhouseModule.mac_address,
+            SmartGreenhouseModule.is_active,
+            # Особенность Postgres: у только что вставленной строки системный столбец xmax равен 0,
+            # а у строки, обновлённой через ON CONFLICT DO UPDATE, — номеру транзакции
+            db.literal_column('(xmax = 0)').label('created')
+        )
+        result = db.session.execute(stmt).fetchall()
+        db.session.commit()
+
+        return jsonify({
+            "message": "Модули зарегистрированы",
+            "modules": [{
+                "module_id": row.module_id,
+                "mac_address": row.mac_address,
+                "is_active": row.is_active,
+                "exists": not row.created
+            } for row in result]
+        }), 200
+
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/modules/available', methods=['GET'])
+@login_required
+def get_available_modules():
+    # Запрос выполняется лениво внутри генератора, уже после отправки заголовков:
+    # ошибка БД обрывает поток, логируется и считается как 500 в stream_response
+    modules = (
+        SmartGreenhouseModule.query
+        .filter(SmartGreenhouseModule.id.is_(None))
+        .order_by(SmartGreenhouseModule.module_id)
+        .yield_per(STREAM_CHUNK_ROWS)
+    )
+    items = (m.to_dict() for m in modules)
+    if wants_ndjson():
+        return stream_response(stream_ndjson(items), 'application/x-ndjson'), 200
+    return stream_response(stream_json_array(items), 'application/json'), 200
 
 @app.route('/api/modules/<int:module_id>/claim', methods=['PUT'])
 @login_required
@@ -326,6 +1196,92 @@ def claim_module(module_id):
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/modules/claim/bulk', methods=['PUT'])
+@login_required
+def claim_modules_bulk():
+    try:
+        data = request.get_json() or {}
+        raw_module_ids = data.get('module_ids') or []
+        if not isinstance(raw_module_ids, list):
+            return jsonify({'error': 'Требуется список модулей'}), 400
+        greenhouse_name = data.get('greenhouse_name') or ''
+        if not isinstance(greenhouse_name, str):
+            return jsonify({'error': 'Некорректное имя теплицы'}), 400
+        greenhouse_name = greenhouse_name.strip()
+        try:
+            module_ids = {int(module_id) for module_id in raw_module_ids}
+            main_module_id = data.get('main_module_id')
+            if main_module_id is not None:
+                main_module_id = int(main_module_id)
+        except (ValueError, TypeError):
+            return jsonify({'error': 'Некорректный список модулей'}), 400
+        if not module_ids:
+            return jsonify({'error': 'Требуется список модулей'}), 400
+        if len(module_ids) > BULK_PROVISION_LIMIT:
+            return jsonify({'error': f'Не более {BULK_PROVISION_LIMIT} модулей за запрос'}), 400
+
+        if greenhouse_name:
+            if main_module_id is None or main_module_id not in module_ids:
+                return jsonify({'error': 'Главный модуль должен входить в список модулей'}), 400
+            existing = Greenhouse.query.filter_by(owner_id=current_user.id, greenhouse_name=greenhouse_name).first()
+            if existing:
+                return jsonify({'error': 'У вас уже есть теплица с таким именем'}), 400
+
+        claimed = db.session.execute(
+            update(SmartGreenhouseModule)
+            .where(
+                SmartGreenhouseModule.module_id.in_(module_ids),
+                SmartGreenhouseModule.id.is_(None),
+                SmartGreenhouseModule.greenhouse_id.is_(None)
+            )
+            .values(id=current_user.id)
+            .returning(SmartGreenhouseModule.module_id)
+        ).scalars().all()
+
+        unavailable = sorted(module_ids - set(claimed))
+        if unavailable:
+            db.session.rollback()
+            return jsonify({
+                'error': 'Некоторые модули не найдены или уже заняты',
+                'unavailable_module_ids': unavailable
+            }), 400
+
+        response = {'message': 'Modules claimed successfully', 'module_ids': sorted(claimed)}
+        if greenhouse_name:
+            main_module = SmartGreenhouseModule.query.get(main_module_id)
+            greenhouse = Greenhouse(
+                greenhouse_name=greenhouse_name,
+                owner_id=current_user.id,
+                main_module_id=main_module_id
+            )
+            db.session.add(greenhouse)
+            db.session.flush()
+
+            db.session.execute(
+                update(SmartGreenhouseModule)
+                .where(SmartGreenhouseModule.module_id.in_(module_ids))
+                .values(greenhouse_id=greenhouse.greenhouse_id)
+            )
+            db.session.execute(
+                update(SmartGreenhouseModule)
+                .where(
+                    SmartGreenhouseModule.module_id.in_(module_ids),
+                    SmartGreenhouseModule.module_id != main_module_id
+                )
+                .values(
+                    target_temperature=main_module.target_temperature,
+                    target_humidity=main_module.target_humidity,
+                    target_lighting=main_module.target_lighting
+                )
+            )
+            response['greenhouse'] = greenhouse.to_dict()
+
+        db.session.commit()
+        return jsonify(response), 200
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/modules/<int:module_id>/settings', methods=['GET'])
 def get_module_settings(module_id):
     module = SmartGreenhouseModule.query.get(module_id)
@@ -481,6 +1437,92 @@ def get_user_greenhouses():
     greenhouses = Greenhouse.query.filter_by(owner_id=current_user.id).all()
     return jsonify([g.to_dict() for g in greenhouses]), 200
 
+# Analytics
+ANALYTICS_TARGET_FIELDS = {
+    'temperature': 'target_temperature',
+    'humidity': 'target_humidity',
+    'light': 'target_lighting'
+}
+ANALYTICS_TOLERANCE = {'temperature': 1.0, 'humidity': 5.0, 'light': 10.0}
+ANALYTICS_MAX_HOURS = 24 * 31
+ANALYTICS_CACHE_TTL = 300
+ANALYTICS_CACHE_SIZE = 256
+_analytics_cache = {}
+_analytics_cache_lock = threading.Lock()
+
+def compute_greenhouse_analytics(greenhouse, hours):
+    until = datetime.utcnow()
+    since = until - timedelta(hours=hours)
+    modules = SmartGreenhouseModule.query.filter_by(greenhouse_id=greenhouse.greenhouse_id).all()
+
+    module_results = []
+    rollup_parts = {value_type: [] for value_type in HISTORY_VALUE_TYPES}
+    histories = collect_history_many([m.module_id for m in modules], since, segments=True)
+    for module in modules:
+        history = histories[module.module_id]
+        stats = {}
+        for value_type, segments in history.items():
+            if not segments:
+                stats[value_type] = None
+                continue
+            target = getattr(module, ANALYTICS_TARGET_FIELDS[value_type])
+            arrays = series_arrays(
+                segments, target, ANALYTICS_TOLERANCE[value_type], since, until,
+                app.config['SENSOR_HISTORY_MAX_GAP']
+            )
+            rollup_parts[value_type].append(arrays)
+            stats[value_type] = reduce_series(*arrays)
+        module_results.append({
+            'module_id': module.module_id,
+            'module_name': module.module_name,
+            'is_main': module.module_id == greenhouse.main_module_id,
+            'stats': stats
+        })
+
+    rollup = {}
+    for value_type, parts in rollup_parts.items():
+        if not parts:
+            rollup[value_type] = None
+            continue
+        rollup[value_type] = reduce_series(*(np.concatenate(column) for column in zip(*parts)))
+
+    return {
+        'greenhouse_id': greenhouse.greenhouse_id,
+        'since': since.isoformat(),
+        'until': until.isoformat(),
+        'tolerance': ANALYTICS_TOLERANCE,
+        'greenhouse': rollup,
+        'modules': module_results
+    }
+
+@app.route('/api/greenhouses/<int:greenhouse_id>/analytics', methods=['GET'])
+@login_required
+def get_greenhouse_analytics(greenhouse_id):
+    greenhouse = Greenhouse.query.filter_by(greenhouse_id=greenhouse_id, owner_id=current_user.id).first()
+    if not greenhouse:
+        return jsonify({'error': 'Теплица не найдена или не принадлежит вам'}), 404
+
+    hours = request.args.get('hours', 24, type=int)
+    if hours is None or hours <= 0 or hours > ANALYTICS_MAX_HOURS:
+        return jsonify({'error': f'Диапазон должен быть от 1 до {ANALYTICS_MAX_HOURS} часов'}), 400
+
+    cache_key = (greenhouse_id, hours)
+    with _analytics_cache_lock:
+        cached = _analytics_cache.get(cache_key)
+    if cached and time.monotonic() - cached[0] < ANALYTICS_CACHE_TTL:
+        return jsonify(cached[1]), 200
+
+    result = compute_greenhouse_analytics(greenhouse, hours)
+    with _analytics_cache_lock:
+        now = time.monotonic()
+        # Устаревшие записи выбрасываем при записи; если кэш всё равно полон — самые старые
+        for key in [key for key, (stored, _) in _analytics_cache.items() if now - stored >= ANALYTICS_CACHE_TTL]:
+            del _analytics_cache[key]
+        while len(_analytics_cache) >= ANALYTICS_CACHE_SIZE:
+            del _analytics_cache[min(_analytics_cache, key=lambda key: _analytics_cache[key][0])]
+        _analytics_cache[cache_key] = (now, result)
+    return jsonify(result), 200
+
 # Adjust 
 TARGET_TEMPERATURE = 25  
 TARGET_HUMIDITY = 50    
@@ -519,6 +1561,8 @@ def adjust_parameters():
         "Humidity": "ON" if module.target_humidity is not None and humidity < float(module.target_humidity) else "OFF",
         "Light": "ON" if module.target_lighting is not None and float(light) < float(module.target_lighting) else "OFF",
 }
+        for parameter, decision in adjustments.items():
+            metrics.inc('adjust_decisions_total', (('parameter', parameter), ('decision', decision)))
 
         return jsonify(adjustments), 200
 
@@ -538,54 +1582,125 @@ def update_sensor_values(module_id):
     if 'temperature' in data:
         module.last_temperature = data['temperature']
         module.last_temperature_updated = now
-        db.session.add(SensorHistory(
-            module_id=module_id,
-            value_type='temperature',
-            value=float(data['temperature']),
-            timestamp=now
-        ))
+        record_reading(module_id, 'temperature', float(data['temperature']), now)
     if 'humidity' in data:
         module.last_humidity = data['humidity']
         module.last_humidity_updated = now
-        db.session.add(SensorHistory(
-            module_id=module_id,
-            value_type='humidity',
-            value=float(data['humidity']),
-            timestamp=now
-        ))
+        record_reading(module_id, 'humidity', float(data['humidity']), now)
     if 'light' in data:
         module.last_light = data['light']
         module.last_light_updated = now
-        db.session.add(SensorHistory(
-            module_id=module_id,
-            value_type='light',
-            value=float(data['light']),
-            timestamp=now
-        ))
+        record_reading(module_id, 'light', float(data['light']), now)
 
     db.session.commit()
     return jsonify({'message': 'Показания обновлены'}), 200
 
 
+HISTORY_MAX_HOURS = 24 * 31
+HISTORY_MAX_POINTS = 5000
+
+def parse_history_args():
+    hours = request.args.get('hours', 24, type=int)
+    if hours is None or hours <= 0 or hours > HISTORY_MAX_HOURS:
+        return None, (jsonify({'error': f'Диапазон должен быть от 1 до {HISTORY_MAX_HOURS} часов'}), 400)
+    max_points = request.args.get('max_points', type=int)
+    if 'max_points' in request.args and (max_points is None or not 3 <= max_points <= HISTORY_MAX_POINTS):
+        return None, (jsonify({'error': f'max_points должен быть от 3 до {HISTORY_MAX_POINTS}'}), 400)
+    return {
+        'since': datetime.utcnow() - timedelta(hours=hours),
+        'max_points': max_points,
+        'segments': request.args.get('segments') == '1'
+    }, None
+
+def format_history(history, max_points=None, segments=False):
+    result = {}
+    for value_type, points in history.items():
+        if segments:
+            result[value_type] = [{
+                "start": p[0].isoformat(),
+                "end": p[1].isoformat(),
+                "value": p[2],
+                "count": p[3]
+            } for p in points]
+            continue
+        if max_points:
+            points = downsample_points(points, max_points)
+        result[value_type] = [{"time": p[0].isoformat(), "value": p[1]} for p in points]
+    return result
+
 @app.route('/api/modules/<int:module_id>/history-24h', methods=['GET'])
 @login_required
 def get_module_history_24h(module_id):
-    from datetime import datetime, timedelta
-    since = datetime.utcnow() - timedelta(hours=24)
-    history = (
-        db.session.query(SensorHistory)
-        .filter(SensorHistory.module_id == module_id, SensorHistory.timestamp >= since)
-        .order_by(SensorHistory.timestamp)
+    args, error = parse_history_args()
+    if error:
+        return error
+    # Только прореживанию нужна вся серия сразу, остальное (включая отрезки) отдаём потоком
+    if args['max_points'] and not args['segments']:
+        history = collect_history(module_id, args['since'])
+        return jsonify(format_history(history, args['max_points'])), 200
+
+    since = args['since']
+    segments = args['segments']
+
+    def items(value_type):
+        for point in iter_history(module_id, value_type, since, segments=segments):
+            if segments:
+                yield {
+                    "start": point[0].isoformat(),
+                    "end": point[1].isoformat(),
+                    "value": point[2],
+                    "count": point[3]
+                }
+            else:
+                yield {"time": point[0].isoformat(), "value": point[1]}
+
+    if wants_ndjson():
+        def generate():
+            for value_type in HISTORY_VALUE_TYPES:
+                yield from stream_ndjson(dict(item, value_type=value_type) for item in items(value_type))
+        return stream_response(generate(), 'application/x-ndjson'), 200
+
+    def generate():
+        for i, value_type in enumerate(HISTORY_VALUE_TYPES):
+            yield from stream_json_array(items(value_type), prefix=('{' if i == 0 else ',') + json.dumps(value_type) + ':')
+        yield '}'
+    return stream_response(generate(), 'application/json'), 200
+
+@app.route('/api/greenhouses/<int:greenhouse_id>/history', methods=['GET'])
+@login_required
+def get_greenhouse_history(greenhouse_id):
+    greenhouse = Greenhouse.query.filter_by(greenhouse_id=greenhouse_id, owner_id=current_user.id).first()
+    if not greenhouse:
+        return jsonify({'error': 'Теплица не найдена или не принадлежит вам'}), 404
+    args, error = parse_history_args()
+    if error:
+        return error
+
+    modules = (
+        SmartGreenhouseModule.query
+        .filter_by(greenhouse_id=greenhouse_id)
+        .order_by(SmartGreenhouseModule.module_id)
         .all()
     )
-    result = {"temperature": [], "humidity": [], "light": []}
-    for entry in history:
-        if entry.value_type in result:
-            result[entry.value_type].append({
-                "time": entry.timestamp.isoformat(),
-                "value": float(entry.value)
-            })
-    return jsonify(result), 200
+    histories = iter_history_by_module([m.module_id for m in modules], args['since'], segments=args['segments'])
+
+    def generate():
+        # Отдаём ответ по модулю за раз — клиент может начинать отрисовку до конца передачи
+        yield json.dumps({
+            'greenhouse_id': greenhouse_id,
+            'since': args['since'].isoformat()
+        })[:-1] + ', "modules": ['
+        for i, (module, (module_id, history)) in enumerate(zip(modules, histories)):
+            chunk = json.dumps({
+                'module_id': module_id,
+                'module_name': module.module_name,
+                'is_main': module_id == greenhouse.main_module_id,
+                'history': format_history(history, args['max_points'], args['segments'])
+            }, ensure_ascii=False)
+            yield (',' if i else '') + chunk
+        yield ']}'
+
+    return stream_response(generate(), 'application/json'), 200
 
 @app.route('/api/modules/<int:module_id>/unclaim', methods=['PUT'])
 @login_required
@@ -633,6 +1748,44 @@ def unclaim_module(module_id):
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@app.cli.command('archive-history')
+@click.option('--module-id', type=int, default=None, help='Архивировать только указанный модуль')
+@click.option('--older-than-days', type=int, default=30, help='Архивировать показания старше N дней')
+@click.option('--keep', is_flag=True, help='Не удалять заархивированные строки и отрезки из живых таблиц')
+def archive_history_command(module_id, older_than_days, keep):
+    end = datetime.utcnow() - timedelta(days=older_than_days)
+    if module_id is not None:
+        module_ids = [module_id]
+    else:
+        module_ids = sorted(
+            {row.module_id for row in
+             db.session.query(SensorHistory.module_id).filter(SensorHistory.timestamp < end).distinct()}
+            | {row.module_id for row in
+               db.session.query(SensorHistorySegment.module_id).filter(SensorHistorySegment.end_time < end).distinct()}
+        )
+
+    for mid in module_ids:
+        starts = [
+            db.session.query(db.func.min(SensorHistory.timestamp)).filter(
+                SensorHistory.module_id == mid, SensorHistory.timestamp < end
+            ).scalar(),
+            db.session.query(db.func.min(SensorHistorySegment.start_time)).filter(
+                SensorHistorySegment.module_id == mid, SensorHistorySegment.end_time < end
+            ).scalar()
+        ]
+        starts = [value for value in starts if value is not None]
+        start = min(starts) if starts else None
+        last_archived = db.session.query(db.func.max(SensorHistoryArchive.end_time)).filter(
+            SensorHistoryArchive.module_id == mid
+        ).scalar()
+        if last_archived is not None and start is not None:
+            start = max(start, last_archived)
+        if start is None or start >= end:
+            continue
+        archive = export_history(mid, start, end, delete=not keep)
+        if archive:
+            click.echo(f"Модуль {mid}: {archive.row_count} строк -> {archive.path}")
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
@@ -0,0 +1 @@
+# Каталог Backend попадает в sys.path, чтобы тесты импортировали модули сервера напрямую
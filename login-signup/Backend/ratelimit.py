@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryRateLimitStore:
+    # Ключи (MAC, module_id, логин) присылает клиент, поэтому число корзин ограничено:
+    # при переполнении вытесняется корзина, к которой дольше всего не обращались
+    MAX_KEYS = 100000
+
+    def __init__(self, max_keys=MAX_KEYS):
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_keys = max_keys
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def consume(self, key, rate, burst, now):
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+
+class RedisRateLimitStore:
+    SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 't', 'u')
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens, updated = tonumber(bucket[1]), tonumber(bucket[2])
+if tokens == nil then tokens = burst; updated = now end
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then tokens = tokens - 1; allowed = 1 end
+redis.call('HSET', KEYS[1], 't', tokens, 'u', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("Для RATE_LIMIT_STORAGE_URL требуется пакет redis")
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def consume(self, key, rate, burst, now):
+        allowed, tokens = self._script(keys=[f"ratelimit:{key}"], args=[rate, burst, now])
+        tokens = float(tokens)
+        return bool(allowed), 0.0 if allowed else (1 - tokens) / rate
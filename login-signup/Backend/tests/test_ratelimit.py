@@ -0,0 +1,35 @@
+from ratelimit import MemoryRateLimitStore
+
+
+def test_bucket_allows_burst_then_rejects():
+    store = MemoryRateLimitStore()
+    results = [store.consume('k', 1.0, 3, 100.0) for _ in range(4)]
+    assert [allowed for allowed, _ in results] == [True, True, True, False]
+    assert results[-1][1] == 1.0
+
+
+def test_bucket_refills_over_time():
+    store = MemoryRateLimitStore()
+    for _ in range(3):
+        store.consume('k', 2.0, 3, 100.0)
+    assert store.consume('k', 2.0, 3, 100.2)[0] is False
+    assert store.consume('k', 2.0, 3, 100.6)[0] is True
+
+
+def test_buckets_are_independent_per_key():
+    store = MemoryRateLimitStore()
+    assert store.consume('a', 1.0, 1, 100.0)[0] is True
+    assert store.consume('a', 1.0, 1, 100.0)[0] is False
+    assert store.consume('b', 1.0, 1, 100.0)[0] is True
+
+
+def test_store_evicts_least_recently_used_bucket():
+    store = MemoryRateLimitStore(max_keys=2)
+    store.consume('a', 1.0, 1, 100.0)
+    store.consume('b', 1.0, 1, 100.0)
+    store.consume('a', 1.0, 1, 100.0)
+    store.consume('c', 1.0, 1, 100.0)
+    assert len(store) == 2
+    # 'b' вытеснена первой и начинается с полной корзины, 'c' осталась пустой
+    assert store.consume('b', 1.0, 1, 100.0)[0] is True
+    assert store.consume('c', 1.0, 1, 100.0)[0] is False
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from timeseries import downsample_points, lttb_indices, reduce_series, series_arrays
+
+T0 = datetime(2026, 1, 1)
+MAX_GAP = timedelta(minutes=10)
+
+
+@pytest.mark.parametrize('n, max_points', [(10, 3), (100, 10), (1000, 300), (1001, 1000), (5000, 7)])
+def test_lttb_keeps_endpoints_and_orders_indices(n, max_points):
+    x = np.arange(n, dtype=np.float64)
+    y = np.sin(x / 7.0)
+    indices = lttb_indices(x, y, max_points)
+    assert indices.size == max_points
+    assert indices[0] == 0
+    assert indices[-1] == n - 1
+    assert np.all(np.diff(indices) > 0)
+
+
+def test_lttb_returns_everything_when_under_limit():
+    x = np.arange(5, dtype=np.float64)
+    assert lttb_indices(x, x, 5).tolist() == [0, 1, 2, 3, 4]
+    assert lttb_indices(x, x, 50).tolist() == [0, 1, 2, 3, 4]
+
+
+def test_downsample_points_keeps_spike():
+    points = [(T0 + timedelta(seconds=10 * i), 100.0 if i == 777 else 0.0) for i in range(2000)]
+    result = downsample_points(points, 100)
+    assert len(result) == 100
+    assert result[0] == points[0] and result[-1] == points[-1]
+    assert (points[777][0], 100.0) in result
+
+
+def test_series_arrays_holds_value_until_next_reading():
+    segments = [
+        (T0, T0, 20.0, 1),
+        (T0 + timedelta(minutes=5), T0 + timedelta(minutes=20), 25.0, 4),
+    ]
+    *_, hours, outside = series_arrays(segments, 24, 1.0, T0, T0 + timedelta(minutes=25), MAX_GAP)
+    # 5 минут до следующего показания; 15 минут отрезка + 5 минут до конца окна
+    assert hours.tolist() == pytest.approx([5 / 60, 20 / 60])
+    assert outside.tolist() == pytest.approx([3.0, 0.0])
+
+
+def test_series_arrays_caps_hold_at_max_gap():
+    segments = [(T0, T0, 24.0, 1), (T0 + timedelta(hours=2), T0 + timedelta(hours=2), 24.0, 1)]
+    *_, hours, _ = series_arrays(segments, 24, 1.0, T0, T0 + timedelta(hours=3), MAX_GAP)
+    assert hours.tolist() == pytest.approx([10 / 60, 10 / 60])
+
+
+def test_series_arrays_clips_segment_to_window_start():
+    segments = [(T0 - timedelta(hours=1), T0 + timedelta(hours=3), 24.0, 100)]
+    starts, _, _, hours, _ = series_arrays(segments, 24, 1.0, T0, T0 + timedelta(hours=4), MAX_GAP)
+    assert starts[0] == np.datetime64(T0, 'us')
+    assert hours.tolist() == pytest.approx([3 + 10 / 60])
+
+
+def test_series_arrays_scales_count_of_clipped_segment():
+    segments = [(T0 - timedelta(hours=1), T0 + timedelta(hours=3), 24.0, 100)]
+    _, _, counts, _, _ = series_arrays(segments, 24, 1.0, T0, T0 + timedelta(hours=4), MAX_GAP)
+    assert counts.tolist() == pytest.approx([75.0])
+
+
+def test_reduce_series_without_target():
+    segments = [(T0, T0, 20.0, 1), (T0 + timedelta(minutes=5), T0 + timedelta(minutes=5), 30.0, 1)]
+    stats = reduce_series(*series_arrays(segments, None, 1.0, T0, T0 + timedelta(minutes=10), MAX_GAP))
+    assert stats['mean'] == pytest.approx(25.0)
+    assert stats['time_in_target_pct'] is None
+    assert stats['degree_hours_outside'] is None
@@ -0,0 +1,80 @@
+import numpy as np
+
+
+def lttb_indices(x, y, max_points):
+    n = x.size
+    if max_points >= n or max_points < 3:
+        return np.arange(n)
+
+    # Первая и последняя точки сохраняются, остальные делятся на max_points - 2 корзины
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    counts = np.diff(edges)
+    avg_x = np.add.reduceat(x[:n - 1], edges[:-1]) / counts
+    avg_y = np.add.reduceat(y[:n - 1], edges[:-1]) / counts
+    next_x = np.append(avg_x[1:], x[-1])
+    next_y = np.append(avg_y[1:], y[-1])
+
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(max_points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        area = np.abs(
+            (x[a] - next_x[i]) * (y[lo:hi] - y[a])
+            - (x[a] - x[lo:hi]) * (next_y[i] - y[a])
+        )
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+def downsample_points(points, max_points):
+    if len(points) <= max_points:
+        return points
+    timestamps = np.array([p[0] for p in points], dtype='datetime64[us]')
+    x = (timestamps - timestamps[0]).astype(np.int64) / 1e6
+    y = np.array([p[1] for p in points], dtype=np.float64)
+    return [points[i] for i in lttb_indices(x, y, max_points)]
+
+
+def series_arrays(segments, target, tolerance, since, until, max_gap):
+    raw_starts = np.array([seg[0] for seg in segments], dtype='datetime64[us]')
+    ends = np.array([seg[1] for seg in segments], dtype='datetime64[us]')
+    values = np.array([seg[2] for seg in segments], dtype=np.float64)
+    counts = np.array([seg[3] for seg in segments], dtype=np.float64)
+
+    # Отрезок, начавшийся до since, учитывается только с начала окна,
+    # а его показания — пропорционально попавшей в окно части
+    starts = np.maximum(raw_starts, np.datetime64(since, 'us'))
+    span_us = (ends - raw_starts).astype(np.int64)
+    kept_us = (ends - starts).astype(np.int64)
+    counts = np.where(span_us > 0, counts * kept_us / np.where(span_us > 0, span_us, 1), counts)
+
+    # Значение действует от начала отрезка до следующего показания, но не дольше допустимого разрыва
+    next_starts = np.append(starts[1:], np.datetime64(until, 'us'))
+    max_gap_us = int(max_gap.total_seconds() * 1e6)
+    held_us = (ends - starts).astype(np.int64) + np.minimum((next_starts - ends).astype(np.int64), max_gap_us)
+    hours = np.clip(held_us, 0, None) / 3.6e9
+
+    if target is None:
+        outside = np.full(values.size, np.nan)
+    else:
+        outside = np.clip(np.abs(values - float(target)) - tolerance, 0, None)
+    return starts, values, counts, hours, outside
+
+
+def reduce_series(starts, values, counts, hours, outside):
+    days, day_index = np.unique(starts.astype('datetime64[D]'), return_inverse=True)
+    daily = np.bincount(day_index, weights=values * counts) / np.bincount(day_index, weights=counts)
+
+    has_target = ~np.isnan(outside)
+    target_hours = hours[has_target].sum()
+    return {
+        'readings': int(round(counts.sum())),
+        'mean': float((values * counts).sum() / counts.sum()),
+        'min': float(values.min()),
+        'max': float(values.max()),
+        'daily_averages': [{'date': str(day), 'value': float(avg)} for day, avg in zip(days, daily)],
+        'time_in_target_pct': float(hours[has_target & (outside == 0)].sum() / target_hours * 100) if target_hours > 0 else None,
+        'degree_hours_outside': float((outside[has_target] * hours[has_target]).sum()) if has_target.any() else None
+    }
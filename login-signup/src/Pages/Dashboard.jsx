@@ -177,7 +177,7 @@ const Dashboard = () => {
     // Получить историю показателей за 24 часа для модуля
     const fetchHistory = async (moduleId) => {
         try {
-            const resp = await fetch(`http://localhost:5000/api/modules/${moduleId}/history-24h`, {
+            const resp = await fetch(`http://localhost:5000/api/modules/${moduleId}/history-24h?max_points=300`, {
                 credentials: 'include',
                 headers: { 'Content-Type': 'application/json' }
             });